@@ -6,6 +6,7 @@
 # - creating a new database                                                            #
 # - creating database tables                                                           #
 # - specific operations to log the status of jobs in the CacheStatus table             #
+# - storing quarantined records in the QuarantinedRecord table                         #
 #                                                                                      #
 # This code is an adaptation and major extension of previous code by Stephan Preeker.  #
 # Curated by Thomas Jongstra 2019 - for the Municipality of Amsterdam                  #
@@ -14,9 +15,10 @@
 # Import public modules.
 import os
 import sys
+import json
 import logging
 import configparser
-from sqlalchemy import create_engine, func, MetaData
+from sqlalchemy import create_engine, func, MetaData, text
 from sqlalchemy import func
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.engine.url import URL
@@ -108,6 +110,24 @@ def create_tables(section="docker"):
     log.warning("Creating defined tables (this is only done when they do not exist yet).")
     models.Base.metadata.create_all(engine, checkfirst=True)
 
+    # Add columns to existing tables, since create_all does not alter tables that were created before these columns existed.
+    add_missing_columns(engine)
+
+
+def add_missing_columns(engine):
+    """
+    Add the columns (and their indices) that were added to existing data models after their tables were first created.
+    The statements are idempotent, so they can be run on every start.
+    """
+    statements = [
+        'ALTER TABLE "CacheStatus" ADD COLUMN IF NOT EXISTS "EntriesQuarantined" INTEGER',
+        'ALTER TABLE "CacheStatus" ADD COLUMN IF NOT EXISTS "QualityCounts" VARCHAR',
+        'CREATE INDEX IF NOT EXISTS "ix_CacheStatus_EntriesQuarantined" ON "CacheStatus" ("EntriesQuarantined")',
+    ]
+    with engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+
 
 def table_exists(name, engine):
     """Checks whether a table exists in the database."""
@@ -136,10 +156,11 @@ def create_job_record(filename, session):
     return new_record.Id
 
 
-def indicate_job_finished(filename, entries_added, table, job_id, session):
+def indicate_job_finished(filename, entries_added, table, job_id, session, entries_quarantined=0, quality_counts=None):
     """
     Update a row in the cache_status table, to indicate that
-    a cache file processing job is completed.
+    a cache file processing job is completed. The quality counts
+    (number of violations per validation rule) are stored as json.
     """
 
     # Get the record for the given job_id.
@@ -150,6 +171,9 @@ def indicate_job_finished(filename, entries_added, table, job_id, session):
     record.FinishedTime = func.now()
     record.EntriesAdded = entries_added
     record.FilledTable = table
+    record.EntriesQuarantined = entries_quarantined
+    if quality_counts is not None:
+        record.QualityCounts = json.dumps(quality_counts)
     session.commit()
 
 
@@ -176,6 +200,30 @@ def check_job_already_completed(filename, session):
          return False
 
 
+#####################################
+# QuarantinedRecord Table Functions #
+#####################################
+
+def store_quarantined_records(quarantined_df, data_model_name, job_id, session):
+    """
+    Store the records that did not pass data validation in the QuarantinedRecord table.
+    Each raw record is stored as json, together with the reason(s) it was quarantined.
+    The records are not committed, so they are committed together with the valid data of the job.
+    """
+
+    # Nothing to store when all records are valid.
+    if len(quarantined_df) == 0:
+        return
+
+    # Convert the raw records (without the reason column) to json strings.
+    raw_records = quarantined_df.drop(columns=['Reason']).to_json(orient='records', lines=True).splitlines()
+
+    # Create the quarantine records, and add them to the database.
+    objects = [{'DataModel': data_model_name, 'Reason': reason, 'Record': record, 'JobId': job_id}
+               for reason, record in zip(quarantined_df['Reason'], raw_records)]
+    session.bulk_insert_mappings(models.QuarantinedRecord, objects)
+
+
 ###########################################
 # Functions for Testing Database Creation #
 ###########################################
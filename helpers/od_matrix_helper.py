@@ -0,0 +1,362 @@
+########################################################################################
+# This file defines methods to build origin-destination (OD) matrices from the         #
+# GvbRitHerkomstBestemmingUurRaw table, such as:                                       #
+#                                                                                      #
+# - maintaining a stable (append-only) stop-index mapping                              #
+# - streaming the rows for a date and uurgroep selection from the database             #
+# - building sparse OD matrices per day from these rows, and summing them over days    #
+# - caching built matrices on disk in a memory-mappable format                         #
+#                                                                                      #
+# Created by Thomas Jongstra 2019 - for the Municipality of Amsterdam                  #
+########################################################################################
+
+# Import public modules.
+import os
+import sys
+import json
+import hashlib
+import time
+import logging
+import datetime
+import contextlib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sqlalchemy import select, func
+
+# Add the parent paths to sys.path, so our own modules and configuration files can be imported.
+parent_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir)
+sys.path.append(parent_path)
+
+# Import own modules.
+from models import models
+
+# Turn on logging.
+log = logging.getLogger(__name__)
+
+# Set the directory in which built OD matrices are cached. This is deliberately not the download
+# cache directory of the scraper, since every file in that directory is processed as GVB raw data.
+OD_MATRIX_CACHE_DIRECTORY = os.path.abspath('./od_matrix_cache')
+
+# Set the name of the file which contains the stop-index mapping (within the OD matrix cache directory).
+STOP_INDEX_FILENAME = 'stop_index.npy'
+
+# Set the name of the lock file which is held while the stop-index mapping is loaded, extended and saved,
+# and the number of seconds to wait for another process to release it.
+STOP_INDEX_LOCK_FILENAME = 'stop_index.lock'
+STOP_INDEX_LOCK_TIMEOUT = 3600
+
+# Set the number of database rows which are loaded into memory at once when streaming OD data.
+CHUNK_SIZE = 500000
+
+
+################################
+# Stop-Index Mapping Functions #
+################################
+
+def check_od_matrix_cache_directory():
+    """Create the OD matrix cache directory when it does not exist yet."""
+    if not os.path.isdir(OD_MATRIX_CACHE_DIRECTORY):
+        os.makedirs(OD_MATRIX_CACHE_DIRECTORY)
+        log.info(f'Created the OD matrix cache directory at location "{OD_MATRIX_CACHE_DIRECTORY}".')
+
+
+def load_stop_index():
+    """
+    Load the stop-index mapping from the OD matrix cache directory. The mapping is an array
+    of stop codes, in which the position of a stop code is its row/column index in every OD matrix.
+    """
+    stop_index_path = os.path.join(OD_MATRIX_CACHE_DIRECTORY, STOP_INDEX_FILENAME)
+    if not os.path.isfile(stop_index_path):
+        return np.array([], dtype=str)
+    return np.load(stop_index_path)
+
+
+def save_stop_index(stop_index):
+    """
+    Save the stop-index mapping in the OD matrix cache directory. The mapping is written to a temporary
+    file first, and then moved into place, so a partially written mapping is never loaded.
+    """
+    check_od_matrix_cache_directory()
+    stop_index_path = os.path.join(OD_MATRIX_CACHE_DIRECTORY, STOP_INDEX_FILENAME)
+    temporary_path = f'{stop_index_path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as outfile:
+        np.save(outfile, stop_index)
+    os.replace(temporary_path, stop_index_path)
+
+
+@contextlib.contextmanager
+def stop_index_lock():
+    """
+    Hold a lock file while the stop-index mapping is loaded, extended and saved. Otherwise concurrent builds
+    could assign the same new indices to different stops, and the last saved mapping would silently win.
+    """
+    check_od_matrix_cache_directory()
+    lock_path = os.path.join(OD_MATRIX_CACHE_DIRECTORY, STOP_INDEX_LOCK_FILENAME)
+    start_time = time.time()
+    while True:
+        try:
+            lock_file = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.time() - start_time > STOP_INDEX_LOCK_TIMEOUT:
+                raise TimeoutError(f'Could not acquire the stop-index lock "{lock_path}". Remove this file when no other OD matrix build is running.')
+            time.sleep(1)
+    try:
+        yield
+    finally:
+        os.close(lock_file)
+        os.remove(lock_path)
+
+
+def get_stop_index_hash(stop_index):
+    """Create a hash of a stop-index mapping, which identifies the mapping a matrix was built with."""
+    return hashlib.sha1('\n'.join(stop_index).encode('utf-8')).hexdigest()
+
+
+def extend_stop_index(stop_index, chunk):
+    """
+    Append the stop codes of a chunk of OD rows which are not in the stop-index mapping yet.
+    New stop codes are only appended, so the index of a stop never changes once it has been assigned.
+    """
+
+    # Find the unseen stop codes (sorted, so the mapping does not depend on the database ordering).
+    chunk_stop_codes = pd.concat([chunk['VertrekHalteCode'], chunk['AankomstHalteCode']]).dropna().astype(str).unique()
+    new_stop_codes = np.setdiff1d(chunk_stop_codes, stop_index)
+    if len(new_stop_codes) > 0:
+        stop_index = np.concatenate([stop_index.astype(str), new_stop_codes.astype(str)])
+        log.info(f'Added {len(new_stop_codes)} new stop codes to the stop-index mapping ({len(stop_index)} stops in total).')
+
+    return stop_index
+
+
+###########################
+# OD Data Query Functions #
+###########################
+
+def normalise_dates(dates):
+    """
+    Convert a date, a date string or an iterable of these
+    to a sorted list of unique date objects.
+    """
+    if isinstance(dates, (str, datetime.date)):
+        dates = [dates]
+    return sorted(set(pd.to_datetime(list(dates)).date))
+
+
+def filter_od_query(query, dates, uurgroepen=None):
+    """Restrict a query on the GvbRitHerkomstBestemmingUurRaw table to the given dates and uurgroepen."""
+    table = models.GvbRitHerkomstBestemmingUurRaw.__table__
+    query = query.where(table.c.Datum.in_(normalise_dates(dates)))
+    if uurgroepen is not None:
+        query = query.where(table.c.UurgroepOmschrijvingVanVertrek.in_(list(uurgroepen)))
+    return query
+
+
+def get_data_versions(engine, dates, uurgroepen=None):
+    """
+    Get a version of the data of each given date (and uurgroep selection), consisting of the number of rows
+    and the highest JobId. A cached matrix is only used when the version of its data has not changed since.
+    """
+    table = models.GvbRitHerkomstBestemmingUurRaw.__table__
+    query = select(table.c.Datum, func.count(), func.max(table.c.JobId)).group_by(table.c.Datum)
+    query = filter_od_query(query, dates, uurgroepen)
+    with engine.connect() as conn:
+        rows = conn.execute(query).fetchall()
+    return {pd.to_datetime(date).date(): [int(count), max_job_id] for date, count, max_job_id in rows}
+
+
+def stream_od_rows(engine, dates, uurgroepen=None, chunksize=CHUNK_SIZE):
+    """
+    Stream the rows of the GvbRitHerkomstBestemmingUurRaw table for the given dates (and optionally uurgroepen),
+    as dataframes of at most chunksize rows. Only the columns needed for the OD matrices are loaded.
+    """
+
+    # Select only the columns needed to build the OD matrices, for the given dates and uurgroepen.
+    table = models.GvbRitHerkomstBestemmingUurRaw.__table__
+    query = select(table.c.Datum, table.c.VertrekHalteCode, table.c.AankomstHalteCode, table.c.AantalRitten)
+    query = filter_od_query(query, dates, uurgroepen)
+
+    # Use a server side cursor, so the database does not send the whole selection at once.
+    with engine.connect().execution_options(stream_results=True) as conn:
+        for chunk in pd.read_sql(query, conn, chunksize=chunksize):
+            yield chunk
+
+
+###############################
+# OD Matrix Builder Functions #
+###############################
+
+def chunk_to_od_matrix(chunk, stop_index):
+    """Convert a dataframe chunk of OD rows into a sparse OD matrix, using the given stop-index mapping."""
+
+    # Map the stop codes to their indices. Missing stop codes get the code -1.
+    stop_codes = pd.CategoricalDtype(categories=stop_index)
+    origins = chunk['VertrekHalteCode'].astype(stop_codes).cat.codes.values
+    destinations = chunk['AankomstHalteCode'].astype(stop_codes).cat.codes.values
+    counts = chunk['AantalRitten'].fillna(0).values.astype(np.int64)
+
+    # Drop rows without a stop code.
+    known = (origins >= 0) & (destinations >= 0)
+    if not known.all():
+        log.warning(f'Skipped {(~known).sum()} OD rows without a departure or arrival stop code.')
+
+    # Duplicate origin-destination pairs are summed when converting the coo matrix to a csr matrix.
+    n_stops = len(stop_index)
+    matrix = sp.coo_matrix((counts[known], (origins[known], destinations[known])), shape=(n_stops, n_stops))
+    return matrix.tocsr()
+
+
+def resize_od_matrix(matrix, n_stops):
+    """
+    Resize an OD matrix to n_stops x n_stops. Since the stop-index mapping is append-only,
+    matrices built with an older mapping only need to be padded with empty rows and columns.
+    """
+    if matrix.shape[0] > n_stops:
+        raise ValueError(f'An OD matrix of {matrix.shape[0]} stops cannot be resized to {n_stops} stops without losing data.')
+    matrix = sp.csr_matrix(matrix)
+    if matrix.shape != (n_stops, n_stops):
+        matrix.resize((n_stops, n_stops))
+    return matrix
+
+
+def sum_od_matrices(matrices, n_stops):
+    """Sum a list of OD matrices (e.g. matrices of separate days), padding them to n_stops x n_stops first."""
+    total = sp.csr_matrix((n_stops, n_stops), dtype=np.int64)
+    for matrix in matrices:
+        total = total + resize_od_matrix(matrix, n_stops)
+    return total
+
+
+def build_daily_od_matrices(engine, dates, uurgroepen=None):
+    """
+    Build a sparse OD matrix (departure stops x arrival stops) per given date, containing the summed AantalRitten
+    of the given uurgroepen. Returns a dict date -> matrix and the (possibly extended) stop-index mapping.
+    """
+
+    matrices = {}
+
+    # The mapping is locked from loading until saving, so concurrent builds extend it one after another.
+    with stop_index_lock():
+        stop_index = load_stop_index()
+
+        # Stream the rows in chunks, and add the matrix of each day in a chunk to the matrix of that day.
+        # This keeps the memory usage bounded by the chunk size.
+        for chunk in stream_od_rows(engine, dates, uurgroepen):
+            stop_index = extend_stop_index(stop_index, chunk)
+            chunk['Datum'] = pd.to_datetime(chunk['Datum']).dt.date
+            for date, day_chunk in chunk.groupby('Datum'):
+                day_matrix = chunk_to_od_matrix(day_chunk, stop_index)
+                if date in matrices:
+                    day_matrix = resize_od_matrix(matrices[date], len(stop_index)) + day_matrix
+                matrices[date] = day_matrix
+
+        # Save the mapping before any matrix that depends on it is cached.
+        save_stop_index(stop_index)
+
+    # Dates without rows get an empty matrix. Matrices of earlier chunks are padded to the final mapping size.
+    n_stops = len(stop_index)
+    matrices = {date: resize_od_matrix(matrices.get(date, sp.csr_matrix((n_stops, n_stops), dtype=np.int64)), n_stops)
+                for date in normalise_dates(dates)}
+
+    return matrices, stop_index
+
+
+#############################
+# OD Matrix Cache Functions #
+#############################
+
+def get_od_matrix_cache_key(date, uurgroepen=None):
+    """Create a unique key for a date and uurgroep selection, which is used as name of the cached matrix."""
+    selection = {
+        'table': models.GvbRitHerkomstBestemmingUurRaw.__tablename__,
+        'date': str(date),
+        'uurgroepen': sorted(uurgroepen) if uurgroepen is not None else None,
+    }
+    return hashlib.sha1(json.dumps(selection, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_od_matrix_version(data_version, stop_index):
+    """
+    Create the version of a cached OD matrix, consisting of the version of its data
+    and the length and hash of the stop-index mapping it was built with.
+    """
+    return {'data': data_version, 'n_stops': len(stop_index), 'stop_index_hash': get_stop_index_hash(stop_index)}
+
+
+def save_od_matrix(matrix, cache_key, data_version, stop_index):
+    """
+    Save an OD matrix to the OD matrix cache directory, together with the version of the data and
+    the stop-index mapping it was built from. The csr arrays are stored as separate uncompressed .npy files, so they can be memory-mapped when loading the matrix again.
+    """
+    matrix_directory = os.path.join(OD_MATRIX_CACHE_DIRECTORY, cache_key)
+    os.makedirs(matrix_directory, exist_ok=True)
+    np.save(os.path.join(matrix_directory, 'data.npy'), matrix.data)
+    np.save(os.path.join(matrix_directory, 'indices.npy'), matrix.indices)
+    np.save(os.path.join(matrix_directory, 'indptr.npy'), matrix.indptr)
+    np.save(os.path.join(matrix_directory, 'shape.npy'), np.array(matrix.shape))
+    with open(os.path.join(matrix_directory, 'version.json'), 'w') as outfile:
+        json.dump(get_od_matrix_version(data_version, stop_index), outfile)
+    log.info(f'Saved OD matrix "{cache_key}" in the OD matrix cache.')
+
+
+def load_od_matrix(cache_key, data_version, stop_index):
+    """
+    Load a cached OD matrix using memory-mapping. Returns None when the matrix is not in the cache, when it was
+    built from another version of the data, or when its stop-index mapping is not a prefix of the given mapping.
+    """
+    matrix_directory = os.path.join(OD_MATRIX_CACHE_DIRECTORY, cache_key)
+    version_path = os.path.join(matrix_directory, 'version.json')
+    if not os.path.isfile(version_path):
+        return None
+    with open(version_path) as infile:
+        version = json.load(infile)
+    if version.get('data') != data_version:
+        log.info(f'The data of OD matrix "{cache_key}" has changed since it was cached. The matrix is rebuilt.')
+        return None
+    n_stops = version.get('n_stops')
+    if n_stops is None or n_stops > len(stop_index) or version.get('stop_index_hash') != get_stop_index_hash(stop_index[:n_stops]):
+        log.warning(f'The stop-index mapping of OD matrix "{cache_key}" does not match the current mapping. The matrix is rebuilt.')
+        return None
+    data = np.load(os.path.join(matrix_directory, 'data.npy'), mmap_mode='r')
+    indices = np.load(os.path.join(matrix_directory, 'indices.npy'), mmap_mode='r')
+    indptr = np.load(os.path.join(matrix_directory, 'indptr.npy'), mmap_mode='r')
+    shape = tuple(np.load(os.path.join(matrix_directory, 'shape.npy')))
+    if shape != (n_stops, n_stops):
+        log.warning(f'The shape of OD matrix "{cache_key}" does not match its stop-index mapping. The matrix is rebuilt.')
+        return None
+    return sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def get_od_matrix(engine, dates, uurgroepen=None, use_cache=True):
+    """
+    Get the OD matrix for the given dates and uurgroepen, summed over all dates. The matrix of each date is
+    loaded from the OD matrix cache when its data has not changed since, otherwise it is built from the database and cached.
+    Returns the matrix and the stop-index mapping, in which position i holds the stop code of row/column i.
+    """
+
+    dates = normalise_dates(dates)
+    data_versions = get_data_versions(engine, dates, uurgroepen)
+    empty_version = [0, None]
+
+    # Try to load the matrix of each date from the cache. Only matrices built with a prefix of the current mapping are used.
+    matrices = {}
+    if use_cache:
+        stop_index = load_stop_index()
+        for date in dates:
+            matrix = load_od_matrix(get_od_matrix_cache_key(date, uurgroepen), data_versions.get(date, empty_version), stop_index)
+            if matrix is not None:
+                matrices[date] = matrix
+        log.info(f'Loaded {len(matrices)} of {len(dates)} daily OD matrices from the OD matrix cache.')
+
+    # Build the matrices of the other dates from the database (in one pass), and save them in the cache.
+    missing_dates = [date for date in dates if date not in matrices]
+    if missing_dates:
+        built_matrices, stop_index = build_daily_od_matrices(engine, missing_dates, uurgroepen)
+        for date, matrix in built_matrices.items():
+            save_od_matrix(matrix, get_od_matrix_cache_key(date, uurgroepen), data_versions.get(date, empty_version), stop_index)
+        matrices.update(built_matrices)
+
+    # Sum the daily matrices. Matrices cached with an older stop-index mapping are padded.
+    stop_index = load_stop_index()
+    return sum_od_matrices(matrices.values(), len(stop_index)), stop_index
@@ -0,0 +1,170 @@
+########################################################################################
+# This file defines methods to validate the parsed GVB data before it is stored        #
+# in the database, such as:                                                            #
+#                                                                                      #
+# - deriving the validation rules of a data model from its column definitions          #
+# - checking these rules column-wise (vectorised) on a dataframe                       #
+# - splitting a dataframe in valid records and quarantined (invalid) records           #
+#                                                                                      #
+# Created by Thomas Jongstra 2019 - for the Municipality of Amsterdam                  #
+########################################################################################
+
+# Import public modules.
+import os
+import sys
+import logging
+import numpy as np
+import pandas as pd
+from sqlalchemy import Date, Float, Integer
+
+# Add the parent paths to sys.path, so our own modules can be imported.
+parent_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir)
+sys.path.append(parent_path)
+
+# Turn on logging.
+log = logging.getLogger(__name__)
+
+# Set the bounds for valid coordinates. These bounds (generously) enclose the Netherlands.
+LAT_BOUNDS = (50.5, 53.7)
+LON_BOUNDS = (3.2, 7.3)
+
+# Set the date formats that are accepted in the raw data, in the order in which they are tried.
+# Dates are never parsed with a guessed format, so dates in another format are quarantined instead of loaded wrongly.
+DATE_FORMATS = ('%Y-%m-%d', '%d-%m-%Y')
+
+# Set the column name prefixes and suffixes of the columns which (together with the date column) identify a record.
+KEY_COLUMN_PREFIXES = ('UurgroepOmschrijving',)
+KEY_COLUMN_SUFFIXES = ('HalteCode',)
+
+
+####################################
+# Validation Rule Helper Functions #
+####################################
+
+def get_column_groups(data_model):
+    """
+    Group the columns of a data model by the validation rule that applies to them.
+    The rules are derived from the column types and names, so new data models are validated automatically.
+    """
+    groups = {'date': [], 'lat': [], 'lon': [], 'count': [], 'key': []}
+    for column in data_model.__table__.columns:
+        name = column.name
+        if name in ['Id', 'JobId']:  # These columns are not present in the raw data.
+            continue
+        if isinstance(column.type, Date):
+            groups['date'].append(name)
+            groups['key'].append(name)
+        elif isinstance(column.type, Float) and name.endswith('Lat'):
+            groups['lat'].append(name)
+        elif isinstance(column.type, Float) and name.endswith('Lon'):
+            groups['lon'].append(name)
+        elif isinstance(column.type, Integer) and name.startswith('Aantal'):
+            groups['count'].append(name)
+        elif name.startswith(KEY_COLUMN_PREFIXES) or name.endswith(KEY_COLUMN_SUFFIXES):
+            groups['key'].append(name)
+    return groups
+
+
+def invalid_coordinates(values, bounds):
+    """Return a mask of coordinates that are not numeric or lie outside the given bounds. Missing coordinates are allowed."""
+    numbers = pd.to_numeric(values, errors='coerce')
+    unparseable = values.notna() & numbers.isna()
+    out_of_bounds = numbers.notna() & ~numbers.between(*bounds)
+    return unparseable | out_of_bounds, numbers
+
+
+def invalid_counts(values):
+    """Return a mask of counts that are missing, not a whole number or negative."""
+    numbers = pd.to_numeric(values, errors='coerce')
+    invalid = numbers.isna() | (numbers < 0) | (numbers != np.floor(numbers))
+    return invalid, numbers
+
+
+def invalid_dates(values):
+    """
+    Return a mask of dates that are missing or do not match any of the DATE_FORMATS.
+    Each format is only tried on the values that did not match the previous formats.
+    """
+    dates = pd.to_datetime(values, format=DATE_FORMATS[0], errors='coerce')
+    for date_format in DATE_FORMATS[1:]:
+        if not dates.isna().any():
+            break
+        unparsed = dates.isna() & values.notna()
+        dates[unparsed] = pd.to_datetime(values[unparsed], format=date_format, errors='coerce')
+    return dates.isna(), dates
+
+
+########################
+# Validation Functions #
+########################
+
+def validate_data(df, data_model):
+    """
+    Validate a parsed dataframe against the rules of its data model. All rules are checked column-wise.
+    Returns a dataframe with the valid records (with converted column types), a dataframe with the
+    invalid records (in their raw form, with a 'Reason' column) and a dict with the number of violations per rule.
+    """
+
+    groups = get_column_groups(data_model)
+    violations = {}
+    converted = {}
+
+    # Check each rule on its columns, and keep the converted values for loading the valid records.
+    for column in groups['date']:
+        violations[f'unparseable_{column}'], converted[column] = invalid_dates(df[column])
+    for column in groups['lat']:
+        violations[f'invalid_{column}'], converted[column] = invalid_coordinates(df[column], LAT_BOUNDS)
+    for column in groups['lon']:
+        violations[f'invalid_{column}'], converted[column] = invalid_coordinates(df[column], LON_BOUNDS)
+    for column in groups['count']:
+        violations[f'invalid_{column}'], converted[column] = invalid_counts(df[column])
+    violations = {rule: mask.values for rule, mask in violations.items()}
+
+    # Combine the masks of all column rules.
+    invalid = np.zeros(len(df), dtype=bool)
+    for mask in violations.values():
+        invalid |= mask
+
+    # Select the valid records, and only replace the columns of which the type has changed by the conversion.
+    # Counts are floats when the raw column contained missing values, so these are converted to integers.
+    valid_df = df[~invalid]
+    changed_columns = {column: values[~invalid] for column, values in converted.items() if values.dtype != df[column].dtype}
+    for column in groups['count']:
+        if not pd.api.types.is_integer_dtype(df[column]):
+            changed_columns[column] = converted[column][~invalid].astype(np.int64)
+    valid_df = valid_df.assign(**changed_columns)
+
+    # Only the first occurrence of a key among the otherwise valid records is kept. Only duplicates within the
+    # dataframe are found, not keys that are already in the database. The converted dates are used, so equal dates
+    # in another notation are found too.
+    duplicates = valid_df.duplicated(subset=groups['key'], keep='first').values
+    violations['duplicate_key'] = np.zeros(len(df), dtype=bool)
+    violations['duplicate_key'][np.flatnonzero(~invalid)[duplicates]] = True
+    invalid |= violations['duplicate_key']
+    valid_df = valid_df[~duplicates]
+
+    # List the violated rules of each invalid record. Rules without violations are skipped.
+    invalid_rows = np.flatnonzero(invalid)
+    reasons = np.full(len(invalid_rows), '', dtype=object)
+    for rule, mask in violations.items():
+        if mask.any():
+            rule_rows = mask[invalid_rows]
+            reasons[rule_rows] = reasons[rule_rows] + rule + ','
+    quarantined_df = df.iloc[invalid_rows].assign(Reason=[reason.rstrip(',') for reason in reasons])
+
+    quality_counts = {rule: int(mask.sum()) for rule, mask in violations.items()}
+    if invalid.any():
+        log.warning(f'Quarantined {len(invalid_rows)} of {len(df)} records for data model {data_model.__name__}: {quality_counts}')
+
+    return valid_df, quarantined_df, quality_counts
+
+
+def get_rules_failed_by_all_records(quality_counts, number_of_records):
+    """
+    Return the column rules that are violated by every record of a non-empty dataframe. This indicates
+    a change in the format of the source data, rather than some invalid records. Duplicate keys are not
+    considered, since the first occurrence of a key is never a duplicate.
+    """
+    if number_of_records == 0:
+        return []
+    return [rule for rule, count in quality_counts.items() if rule != 'duplicate_key' and count == number_of_records]
@@ -37,6 +37,18 @@ class CacheStatus(Base):
     EntriesAdded = Column(Integer, index=True)
     FilledTable = Column(String, index=True)
     FinishedTime = Column(TIMESTAMP, index=True)
+    EntriesQuarantined = Column(Integer, index=True)
+    QualityCounts = Column(String)
+
+
+class QuarantinedRecord(Base):
+    """This table contains the raw records that did not pass data validation, and were therefore not stored in their data table."""
+    __tablename__ = "QuarantinedRecord"
+    Id = Column(Integer, primary_key=True)
+    DataModel = Column(String, index=True)
+    Reason = Column(String, index=True)
+    Record = Column(String)
+    JobId = Column(Integer, index=True)
 
 
 ############################
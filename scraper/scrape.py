@@ -22,6 +22,7 @@ sys.path.append(parent_path)
 # Import own modules.
 from models import models
 from helpers import db_helper
+from helpers import validation_helper
 
 
 ############################################
@@ -265,19 +266,31 @@ def store_data_in_database():
                 # Get the right data model for the current file.
                 data_model = get_data_model_from_df(df, models)
 
+                # Validate the data, and split off the invalid records. These are stored in the QuarantinedRecord table instead.
+                df, quarantined_df, quality_counts = validation_helper.validate_data(df, data_model)
+
+                # When all records fail the same column rule, the format of the source data has most likely changed.
+                # The job is then left unfinished (and nothing is stored), so the file is processed again once this is fixed.
+                failed_rules = validation_helper.get_rules_failed_by_all_records(quality_counts, len(df) + len(quarantined_df))
+                if failed_rules:
+                    log.error(f'All records of file "{filename}" failed the validation rule(s) {failed_rules}. The file has not been stored, and its job has not been marked as finished.')
+                    continue
+
                 # Add the job id of the current job to all records created with this job.
                 df['JobId'] = job_id
 
                 # Convert the dataframe to a format to be consumed by the database.
                 objects = df.to_dict('records')
 
-                # Commit the data to the database.
+                # Add the valid and quarantined data to the database. These are not committed yet.
                 session.bulk_insert_mappings(data_model, objects)
-                session.commit()
+                db_helper.store_quarantined_records(quarantined_df, data_model.__name__, job_id, session)
 
-                # Update a record in the cache_status table to indicate that the job has been finished.
-                db_helper.indicate_job_finished(filename, len(df), data_model.__name__, job_id, session)
-                log.info(f'Finished processing file {filename}". Stored {len(df)} records in the database.')
+                # Update a record in the cache_status table to indicate that the job has been finished. This commits the
+                # data and the job status in one transaction, so a file is never stored without being marked as finished.
+                db_helper.indicate_job_finished(filename, len(df), data_model.__name__, job_id, session,
+                                                entries_quarantined=len(quarantined_df), quality_counts=quality_counts)
+                log.info(f'Finished processing file {filename}". Stored {len(df)} records in the database, and quarantined {len(quarantined_df)} records.')
 
             # If we find out that the dataframe was emtpy, do 
             except pd.errors.EmptyDataError: